@@ -0,0 +1,40 @@
+import asyncio
+import importlib.util
+import os
+from pathlib import Path
+
+import httpx
+import orjson
+
+# Заголовки запроса к LLM собираются при импорте из FOLDER_ID.
+os.environ.setdefault("FOLDER_ID", "test-folder")
+
+_spec = importlib.util.spec_from_file_location("gateway_app", Path(__file__).parent.parent / "app.py")
+gateway = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(gateway)
+
+
+def _chunk(text: str) -> bytes:
+    return orjson.dumps({"result": {"alternatives": [{"message": {"text": text}}]}}) + b"\n"
+
+
+async def _disconnect_after_first_delta():
+    body = _chunk("Привет") + _chunk("Привет, мир")
+    gateway._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda _r: httpx.Response(200, content=body)))
+    gateway._write_q = asyncio.Queue()
+    req = gateway.AskReq(question="вопрос", user_id="u1")
+    gen = gateway._llm_stream("Bearer x", [], req, "вопрос", "rid")
+    try:
+        await gen.__anext__()
+        # Клиент отключился: Starlette закрывает генератор.
+        await gen.aclose()
+    finally:
+        await gateway._client.aclose()
+    return gateway._write_q
+
+
+def test_turn_saved_when_client_disconnects():
+    q = asyncio.run(_disconnect_after_first_delta())
+    assert q.qsize() == 1
+    rows = q.get_nowait()
+    assert [(r["r"], r["t"]) for r in rows] == [("user", "вопрос"), ("assistant", "Привет")]
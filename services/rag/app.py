@@ -1,24 +1,72 @@
+import asyncio
+import functools
+import hashlib
+import itertools
+import json
+import math
 import os
+import pickle
 import shutil
+import sqlite3
 import threading
+import time
 import logging
-import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 import boto3
+import faiss
+import numpy as np
+import pypdfium2 as pdfium
+import torch
 from botocore.config import Config
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from fastapi.responses import ORJSONResponse
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from pydantic import BaseModel, Field
+from semantic_text_splitter import TextSplitter
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("rag-svc")
 
+# Request id: время старта + pid + счётчик — уникально между контейнерами и без urandom.
+_RID_PREFIX = f"{int(time.time()):x}{os.getpid():x}"
+_rid_seq = itertools.count(1)
+
+
+def _new_rid() -> str:
+    return f"{_RID_PREFIX}-{next(_rid_seq):x}"
+
+
+def _cpu_budget() -> int:
+    """Ядра, реально доступные процессу: affinity, урезанная квотой cgroup (cpus: в compose)."""
+    n = len(os.sched_getaffinity(0))
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            n = min(n, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return n
+
+
 VSTORE_DIR = Path("/data/vectorstore_faiss")
+MANIFEST_FILE = "manifest.json"
+# Каждая сборка пишется в свой каталог builds/<id>, на действующую указывает симлинк
+# current: переключение — один атомарный rename, читатели не видят полупустой каталог.
+# (Сам VSTORE_DIR — точка монтирования тома, переименовать его нельзя.)
+BUILDS_DIR = "builds"
+CURRENT_LINK = "current"
+INDEX_FILE = "index.faiss"
+# Тексты чанков лежат в SQLite и читаются по id только для найденных top-k.
+DOCS_FILE = "docs.sqlite"
 
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
 S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
@@ -27,27 +75,94 @@ S3_PREFIX = os.getenv("S3_PREFIX", "")
 S3_ENDPOINT_URL = "https://storage.yandexcloud.net"
 S3_REGION = "ru-central1"
 
-TMP_DIR = Path("/tmp/rag_s3_tmp")
+# Разобранные документы по (key, ETag): неизменившиеся файлы при реиндексе не качаются и не парсятся.
+PARSE_CACHE_DIR = Path("/app/.cache/rag_parsed")
+# Векторы чанков по хэшу (модель + текст): при реиндексе модель считает только новые чанки.
+EMB_CACHE_PATH = Path("/app/.cache/rag_emb.sqlite3")
+EMB_CACHE_SQL_BATCH = 500
+
+DOWNLOAD_WORKERS = 16
+FETCH_BATCH = 32
+# Объекты крупнее части качаются параллельными Range-запросами (до RANGE_MAX_PARTS штук).
+RANGE_PART_BYTES = 8 * 1024 * 1024
+RANGE_MAX_PARTS = 8
+# Пул процессов разбора и нарезки — в пределах квоты CPU контейнера, как и потоки torch.
+PARSE_WORKERS = min(4, _cpu_budget())
 
 EMB_MODEL = "intfloat/multilingual-e5-base"
+# "torch" — обычный PyTorch; "onnx" — ONNX Runtime с динамическим INT8-квантованием
+# (быстрее на CPU, но векторы немного отличаются, поэтому смена требует переиндексации).
+# ONNX — только явно через env: качество поиска на INT8 не сверено с torch, а экспорт
+# с квантованием идёт внутри rag-svc при первом старте и упирается в mem_limit контейнера.
+EMB_BACKEND = os.getenv("EMB_BACKEND", "torch")
+# Пусто — конфигурация квантования выбирается по флагам CPU (см. _onnx_qconfig).
+EMB_ONNX_QCONFIG = ""
+# При наличии CUDA и EMB_BACKEND="torch" корпус при сборке считается той же моделью на GPU (FP32 —
+# пространство векторов то же, что у запросов на CPU). ONNX INT8 на GPU не воспроизвести — с ним сборка на CPU.
+EMB_BUILD_ON_GPU = True
+EMB_ONNX_DIR = Path("/app/.cache/onnx")
 
 CHUNK_SIZE = 600
 CHUNK_OVERLAP = 200
+# С этого числа документов нарезка идёт пулом процессов (на мелком корпусе дороже запуск пула).
+SPLIT_PARALLEL_MIN_DOCS = 50
 MAX_FILES = 20000
 MAX_CONTEXT_CHARS = 100000
 
+# "hnsw": граф HNSW поверх векторов со скалярным квантованием (int8 на компоненту) — поиск ~O(log N),
+# векторы вчетверо меньше float32.
+# "auto": меньше IVF_MIN_VECTORS векторов — плоский индекс со скалярным квантованием
+# (int8 на компоненту), иначе IVF-PQ; компактнее, если корпус не влезает в RAM.
+INDEX_KIND = "hnsw"
+# Эмбеддинги нормированы: скалярное произведение = косинус, ранжирование как у L2, но без вычитаний.
+INDEX_METRIC = faiss.METRIC_INNER_PRODUCT
+IVF_MIN_VECTORS = 20000
+SQ_TYPE = faiss.ScalarQuantizer.QT_8bit
+IVF_NPROBE = 8
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+CTX_CACHE_SIZE = 4096
+CTX_CACHE_TTL_S = 600
+CTX_SEPARATOR = "\n\n---\n\n"
+MMR_LAMBDA = 0.3
+
 _vs = None
+_vs_lock = threading.Lock()
+# Состояние реиндекса меняется только в потоке event loop — блокировка не нужна.
 _building = False
-_build_lock = threading.Lock()
+_reindex_task: asyncio.Task | None = None
+
+_emb = None
+_emb_lock = threading.Lock()
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+_ctx_cache: TTLCache = TTLCache(maxsize=CTX_CACHE_SIZE, ttl=CTX_CACHE_TTL_S)
+_ctx_cache_lock = threading.Lock()
 
 
 def _s3_client():
+    """Один boto3-клиент на процесс: сборка дорогая, а пул TLS-соединений живёт между реиндексами."""
+    global _s3
+    if _s3 is not None:
+        return _s3
     if not (S3_ACCESS_KEY and S3_SECRET_KEY and S3_BUCKET):
         raise RuntimeError("S3 creds/bucket not set")
+    with _s3_lock:
+        if _s3 is None:
+            _s3 = _new_s3_client()
+    return _s3
+
+
+def _new_s3_client():
     cfg = Config(
         signature_version="s3v4",
         s3={"addressing_style": "virtual"},
         retries={"max_attempts": 5, "mode": "standard"},
+        max_pool_connections=DOWNLOAD_WORKERS,
     )
     return boto3.client(
         "s3",
@@ -60,55 +175,181 @@ def _s3_client():
 
 
 def _iter_s3_keys(client):
-    cont = None
+    """(key, etag, size) подходящих объектов; страницы листинга ведёт paginator boto3."""
     exts = (".pdf", ".txt", ".md")
     seen = 0
-    while True:
-        kwargs = {"Bucket": S3_BUCKET}
-        if S3_PREFIX:
-            kwargs["Prefix"] = S3_PREFIX
-        if cont:
-            kwargs["ContinuationToken"] = cont
-        resp = client.list_objects_v2(**kwargs)
-
-        for it in resp.get("Contents", []):
+    pages = client.get_paginator("list_objects_v2").paginate(
+        Bucket=S3_BUCKET, Prefix=S3_PREFIX, PaginationConfig={"PageSize": 1000}
+    )
+    for page in pages:
+        for it in page.get("Contents", []):
             k = it["Key"]
             if k.lower().endswith(exts):
-                yield k
+                yield k, it.get("ETag", "").strip('"'), it.get("Size", 0)
                 seen += 1
                 if seen >= MAX_FILES:
                     log.warning("hit MAX_FILES=%d, stopping listing", MAX_FILES)
                     return
 
-        if resp.get("IsTruncated"):
-            cont = resp.get("NextContinuationToken")
-        else:
-            break
+
+def _load_pdf(key: str, body: bytes) -> list:
+    """Постраничный текст PDF через PDFium (C++), метаданные как у PyPDFLoader."""
+    pdf = pdfium.PdfDocument(body)
+    try:
+        out = []
+        for i in range(len(pdf)):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            text = textpage.get_text_range().replace("\r\n", "\n")
+            textpage.close()
+            page.close()
+            out.append(Document(page_content=text, metadata={"source": key, "page": i}))
+        return out
+    finally:
+        pdf.close()
 
 
-def _load_local(path: Path):
-    suf = path.suffix.lower()
+def _parse_object(key: str, body: bytes) -> list:
+    """Разбор тела S3-объекта в памяти, без промежуточного файла."""
+    suf = Path(key).suffix.lower()
     if suf == ".pdf":
-        return PyPDFLoader(str(path)).load()
+        return _load_pdf(key, body)
     if suf in {".txt", ".md"}:
-        return TextLoader(str(path), encoding="utf-8").load()
+        return [Document(page_content=body.decode("utf-8", errors="replace"), metadata={"source": key})]
     return []
 
 
-def load_corpus_s3() -> list:
-    c = _s3_client()
-    TMP_DIR.mkdir(exist_ok=True, parents=True)
-    docs, any_found = [], False
+def list_corpus_s3(c) -> dict:
+    """Манифест корпуса: {key: {"etag", "size"}} по всем подходящим объектам."""
+    manifest = {k: {"etag": etag, "size": size} for k, etag, size in _iter_s3_keys(c)}
+    if not manifest:
+        raise RuntimeError("No *.pdf|*.txt|*.md in S3 bucket/prefix")
+    return manifest
 
-    for key in _iter_s3_keys(c):
-        any_found = True
-        local = TMP_DIR / key.replace("/", "__")
-        local.parent.mkdir(parents=True, exist_ok=True)
-        c.download_file(S3_BUCKET, key, str(local))
-        docs.extend(_load_local(local))
 
-    if not any_found:
-        raise RuntimeError("No *.pdf|*.txt|*.md in S3 bucket/prefix")
+def _build_params() -> dict:
+    """Параметры сборки: их смена тоже требует переиндексации."""
+    return {
+        "model": EMB_MODEL,
+        "backend": EMB_BACKEND,
+        "device": "cuda" if _build_on_gpu() else "cpu",
+        "index": f"{INDEX_KIND}-sq8" if INDEX_KIND == "hnsw" else INDEX_KIND,
+        "metric": "ip" if INDEX_METRIC == faiss.METRIC_INNER_PRODUCT else "l2",
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "splitter": "semantic-text-splitter",
+    }
+
+
+def _read_manifest() -> dict | None:
+    try:
+        return json.loads((VSTORE_DIR / MANIFEST_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest: dict):
+    tmp = VSTORE_DIR / f".{MANIFEST_FILE}.tmp"
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, VSTORE_DIR / MANIFEST_FILE)
+
+
+def _ranges(size: int) -> list:
+    """HTTP Range для частей объекта; [None] — качать одним GET."""
+    n = min(RANGE_MAX_PARTS, size // RANGE_PART_BYTES)
+    if n < 2:
+        return [None]
+    step = -(-size // n)
+    return [f"bytes={i}-{min(i + step, size) - 1}" for i in range(0, size, step)]
+
+
+def _fetch(c, key: str, rng: str | None = None, etag: str = "") -> bytes:
+    kwargs = {}
+    if rng:
+        kwargs["Range"] = rng
+        if etag:
+            # Части должны быть от одной версии объекта.
+            kwargs["IfMatch"] = f'"{etag}"'
+    return c.get_object(Bucket=S3_BUCKET, Key=key, **kwargs)["Body"].read()
+
+
+def _parse_cache_path(key: str, etag: str) -> Path | None:
+    if not etag:
+        return None
+    h = hashlib.blake2b(f"{key}\0{etag}".encode("utf-8"), digest_size=16).hexdigest()
+    return PARSE_CACHE_DIR / f"{h}.pkl"
+
+
+def _parse_cache_get(path: Path | None) -> list | None:
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("parse cache entry %s unreadable: %s", path.name, e)
+        return None
+
+
+def _parse_cache_put(path: Path | None, docs: list):
+    if path is None:
+        return
+    tmp = path.with_suffix(".tmp")
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(docs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("parse cache write failed: %s", e)
+
+
+def _parse_cache_prune(keep: set):
+    """Удаляет записи файлов, которых больше нет в корпусе (или с другим ETag)."""
+    for p in PARSE_CACHE_DIR.glob("*.pkl"):
+        if p not in keep:
+            p.unlink(missing_ok=True)
+
+
+def load_corpus_s3(c, files: dict) -> list:
+    """Качает объекты пулом потоков, PDF парсит пулом процессов (разбор упирается в CPU).
+
+    Текстовые файлы декодируются на месте: гонять их тела в воркеры дороже самого разбора.
+    Файлы с тем же ETag берутся из PARSE_CACHE_DIR без скачивания.
+    Идёт пачками по FETCH_BATCH, чтобы в памяти не лежал весь корпус сразу.
+    """
+    PARSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    paths = {k: _parse_cache_path(k, meta.get("etag", "")) for k, meta in files.items()}
+    docs = []
+    keys = []
+    for k, p in paths.items():
+        cached = _parse_cache_get(p)
+        if cached is None:
+            keys.append(k)
+        else:
+            docs.extend(cached)
+    log.info("parse cache: %d hit, %d to fetch", len(paths) - len(keys), len(keys))
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as dl, \
+            ProcessPoolExecutor(max_workers=PARSE_WORKERS) as parse:
+        for i in range(0, len(keys), FETCH_BATCH):
+            batch = keys[i:i + FETCH_BATCH]
+            parts = [(k, r) for k in batch for r in _ranges(files[k].get("size", 0))]
+            got = {}
+            for (k, _), b in zip(parts, dl.map(lambda p: _fetch(c, p[0], p[1], files[p[0]].get("etag", "")), parts)):
+                got.setdefault(k, []).append(b)
+            bodies = [b"".join(got[k]) for k in batch]
+            pdfs = [(k, b) for k, b in zip(batch, bodies) if k.lower().endswith(".pdf")]
+            parsed = [(k, _parse_object(k, b)) for k, b in zip(batch, bodies) if not k.lower().endswith(".pdf")]
+            if pdfs:
+                pdf_keys, pdf_bodies = zip(*pdfs)
+                parsed.extend(zip(pdf_keys, parse.map(_load_pdf, pdf_keys, pdf_bodies)))
+            for k, part in parsed:
+                _parse_cache_put(paths[k], part)
+                docs.extend(part)
+
+    _parse_cache_prune({p for p in paths.values() if p is not None})
 
     docs = [d for d in docs if getattr(d, "page_content", "").strip()]
     if not docs:
@@ -117,70 +358,310 @@ def load_corpus_s3() -> list:
     return docs
 
 
+def _onnx_qconfig() -> str:
+    """Конфигурация INT8 под CPU: VNNI даёт int8-скалярные произведения за одну инструкцию."""
+    if EMB_ONNX_QCONFIG:
+        return EMB_ONNX_QCONFIG
+    try:
+        flags = set(Path("/proc/cpuinfo").read_text().split())
+    except OSError:
+        flags = set()
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    if "avx2" in flags:
+        return "avx2"
+    return "arm64"
+
+
+def _onnx_int8_model() -> tuple[str, str]:
+    """Экспорт модели в ONNX с INT8-квантованием (один раз, результат в кэше)."""
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    qconfig = _onnx_qconfig()
+    out_dir = EMB_ONNX_DIR / EMB_MODEL.replace("/", "__")
+    file_name = f"onnx/model_qint8_{qconfig}.onnx"
+    if not (out_dir / file_name).exists():
+        log.info("Exporting %s to ONNX INT8 (%s)", EMB_MODEL, qconfig)
+        model = SentenceTransformer(EMB_MODEL, device="cpu", backend="onnx")
+        model.save(str(out_dir))
+        export_dynamic_quantized_onnx_model(model, qconfig, str(out_dir))
+    return str(out_dir), file_name
+
+
 def _make_embeddings():
+    """Модель эмбеддингов грузится один раз на процесс и переиспользуется."""
+    global _emb
+    if _emb is None:
+        with _emb_lock:
+            if _emb is None:
+                # По умолчанию torch берёт все ядра хоста, а не квоту контейнера — потоки толкаются.
+                torch.set_num_threads(_cpu_budget())
+                model_name, model_kwargs = EMB_MODEL, {"device": "cpu"}
+                if EMB_BACKEND == "onnx":
+                    model_name, file_name = _onnx_int8_model()
+                    model_kwargs.update(backend="onnx", model_kwargs={"file_name": file_name})
+                _emb = HuggingFaceEmbeddings(
+                    model_name=model_name,
+                    model_kwargs=model_kwargs,
+                    encode_kwargs={
+                        "normalize_embeddings": True,
+                        "batch_size": 128,
+                    },
+                )
+    return _emb
+
+
+def _make_build_embeddings():
+    """Модель для сборки индекса: на GPU — отдельный экземпляр той же модели, иначе общий CPU-экземпляр.
+
+    GPU-экземпляр живёт только на время сборки, чтобы API не держал VRAM между реиндексами.
+    """
+    if not _build_on_gpu():
+        return _make_embeddings()
     return HuggingFaceEmbeddings(
         model_name=EMB_MODEL,
-        model_kwargs={"device": "cpu"},
+        model_kwargs={"device": "cuda"},
         encode_kwargs={
-            "normalize_embeddings": True,   
-            "batch_size": 64,               
+            "normalize_embeddings": True,
+            "batch_size": 128,
         },
     )
 
 
+def _tune_index(index):
+    """Параметры поиска не сохраняются в файле индекса — выставляем их после сборки и загрузки."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = IVF_NPROBE
+    return index
+
+
+def _make_index(vecs: np.ndarray):
+    """HNSW поверх SQ8 по INDEX_KIND, иначе плоский SQ8 для маленького корпуса и IVF-PQ (8 бит на подвектор) для большого."""
+    n, d = vecs.shape
+    if INDEX_KIND == "hnsw":
+        index = faiss.IndexHNSWSQ(d, SQ_TYPE, HNSW_M, INDEX_METRIC)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.train(vecs)
+        index.add(vecs)
+        log.info("built HNSW index: n=%d M=%d", n, HNSW_M)
+        return _tune_index(index)
+
+    if n < IVF_MIN_VECTORS:
+        index = faiss.IndexScalarQuantizer(d, SQ_TYPE, INDEX_METRIC)
+        index.train(vecs)
+        index.add(vecs)
+        return index
+
+    nlist = max(16, min(int(4 * math.sqrt(n)), n // 39))
+    m = max(x for x in range(1, d // 4 + 1) if d % x == 0)
+    index = faiss.IndexIVFPQ(faiss.IndexFlat(d, INDEX_METRIC), d, nlist, m, 8, INDEX_METRIC)
+    index.train(vecs)
+    index.add(vecs)
+    # MMR в langchain восстанавливает векторы по id через reconstruct().
+    index.make_direct_map()
+    log.info("built IVF-PQ index: n=%d nlist=%d m=%d", n, nlist, m)
+    return _tune_index(index)
+
+
+class _SqliteDocstore(Docstore):
+    """Docstore только для чтения поверх docs.sqlite; подключение своё у каждого потока."""
+
+    def __init__(self, path: Path):
+        self._uri = f"file:{path}?mode=ro"
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+            self._local.conn = c
+        return c
+
+    def search(self, search) -> Document | str:
+        row = self._conn().execute("SELECT content, meta FROM docs WHERE id = ?", (int(search),)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+
+def _write_docs(path: Path, chunks: list):
+    c = sqlite3.connect(path)
+    try:
+        c.execute("CREATE TABLE docs (id INTEGER PRIMARY KEY, content TEXT NOT NULL, meta TEXT NOT NULL)")
+        c.executemany(
+            "INSERT INTO docs VALUES (?, ?, ?)",
+            ((i, d.page_content, json.dumps(d.metadata, ensure_ascii=False)) for i, d in enumerate(chunks)),
+        )
+        c.commit()
+    finally:
+        c.close()
+
+
+def _build_on_gpu() -> bool:
+    return EMB_BUILD_ON_GPU and EMB_BACKEND == "torch" and torch.cuda.is_available()
+
+
+def _emb_tag() -> bytes:
+    """Всё, от чего зависят векторы: при смене модели, бэкенда или устройства старые записи не подходят."""
+    qconfig = _onnx_qconfig() if EMB_BACKEND == "onnx" else ""
+    device = "cuda" if _build_on_gpu() else "cpu"
+    return f"{EMB_MODEL}|{EMB_BACKEND}|{qconfig}|{device}\0".encode("utf-8")
+
+
+def _embed_cached(emb, texts: list) -> np.ndarray:
+    """Векторы текстов: найденные в EMB_CACHE_PATH берутся оттуда, остальные считает модель.
+
+    После сборки в кэше остаются только записи текущего корпуса.
+    """
+    tag = _emb_tag()
+    keys = [hashlib.blake2b(tag + t.encode("utf-8"), digest_size=16).digest() for t in texts]
+    EMB_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    c = sqlite3.connect(EMB_CACHE_PATH)
+    try:
+        c.execute("CREATE TABLE IF NOT EXISTS emb (k BLOB PRIMARY KEY, v BLOB NOT NULL) WITHOUT ROWID")
+        uniq = list(dict.fromkeys(keys))
+        found = {}
+        for i in range(0, len(uniq), EMB_CACHE_SQL_BATCH):
+            part = uniq[i:i + EMB_CACHE_SQL_BATCH]
+            q = f"SELECT k, v FROM emb WHERE k IN ({','.join('?' * len(part))})"
+            found.update(c.execute(q, part).fetchall())
+
+        miss = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in miss:
+                miss[k] = t
+        log.info("embedding cache: %d hit, %d to embed", len(uniq) - len(miss), len(miss))
+        if miss:
+            with torch.inference_mode():
+                new = np.asarray(emb.embed_documents(list(miss.values())), dtype=np.float32)
+            rows = [(k, v.tobytes()) for k, v in zip(miss, new)]
+            c.executemany("INSERT OR REPLACE INTO emb VALUES (?, ?)", rows)
+            found.update(rows)
+
+        c.execute("CREATE TEMP TABLE keep (k BLOB PRIMARY KEY) WITHOUT ROWID")
+        c.executemany("INSERT INTO keep VALUES (?)", ((k,) for k in uniq))
+        c.execute("DELETE FROM emb WHERE k NOT IN (SELECT k FROM keep)")
+        c.commit()
+    finally:
+        c.close()
+    return np.stack([np.frombuffer(found[k], dtype=np.float32) for k in keys])
+
+
+@functools.lru_cache(maxsize=4)
+def _splitter(chunk_size: int, chunk_overlap: int) -> TextSplitter:
+    return TextSplitter(chunk_size, overlap=chunk_overlap)
+
+
+def _split_text(text: str, chunk_size: int, chunk_overlap: int) -> list:
+    """Нарезка в Rust (semantic-text-splitter): границы по смыслу — абзац, строка, предложение, слово.
+
+    GIL она не отпускает, поэтому на большом корпусе распараллеливается процессами.
+    """
+    return _splitter(chunk_size, chunk_overlap).chunks(text)
+
+
 def build_store(docs: list, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
     if not docs:
         raise RuntimeError("Empty corpus")
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        separators=["\n\n", "\n", " ", ""],
-    )
-    chunks = splitter.split_documents(docs)
+    texts = [d.page_content for d in docs]
+    if len(docs) >= SPLIT_PARALLEL_MIN_DOCS and PARSE_WORKERS > 1:
+        with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as ex:
+            parts = list(ex.map(_split_text, texts, repeat(chunk_size), repeat(chunk_overlap), chunksize=32))
+    else:
+        parts = [_split_text(t, chunk_size, chunk_overlap) for t in texts]
+    chunks = [
+        Document(page_content=f"passage: {c}", metadata=dict(d.metadata))
+        for d, cs in zip(docs, parts)
+        for c in cs
+    ]
     if not chunks:
         raise RuntimeError("Cannot split corpus")
 
-    for d in chunks:
-        d.page_content = f"passage: {d.page_content.strip()}"
-
-    emb = _make_embeddings()
-    vs = FAISS.from_documents(chunks, emb)
-
-    if VSTORE_DIR.exists():
-        for p in VSTORE_DIR.glob("*"):
-            if p.is_file() or p.is_symlink():
-                p.unlink(missing_ok=True)
-            elif p.is_dir():
-                shutil.rmtree(p, ignore_errors=True)
-    VSTORE_DIR.mkdir(parents=True, exist_ok=True)
-
-    vs.save_local(str(VSTORE_DIR))
-    return vs
+    vecs = _embed_cached(_make_build_embeddings(), [d.page_content for d in chunks])
+    if _build_on_gpu():
+        torch.cuda.empty_cache()
+    index = _make_index(vecs)
+    del vecs
+
+    build_dir = VSTORE_DIR / BUILDS_DIR / _new_rid()
+    build_dir.mkdir(parents=True)
+    faiss.write_index(index, str(build_dir / INDEX_FILE))
+    _write_docs(build_dir / DOCS_FILE, chunks)
+    _swap_current(build_dir)
+    return load_store()
+
+
+def _swap_current(build_dir: Path):
+    """Переключает current на новую сборку; в живых остаётся только она и предыдущая.
+
+    Предыдущую читает ещё опубликованный стор (запросы в полёте, ленивые подключения к SQLite
+    из новых потоков), поэтому она удаляется лишь на следующем реиндексе.
+    """
+    link = VSTORE_DIR / CURRENT_LINK
+    prev = link.resolve() if link.is_symlink() else None
+    tmp = VSTORE_DIR / f".{CURRENT_LINK}.tmp"
+    tmp.unlink(missing_ok=True)
+    os.symlink(build_dir.relative_to(VSTORE_DIR), tmp)
+    os.replace(tmp, link)
+    for p in (VSTORE_DIR / BUILDS_DIR).iterdir():
+        if p != build_dir and p.resolve() != prev:
+            shutil.rmtree(p, ignore_errors=True)
+    # Файлы прежней плоской раскладки: current уже указывает на новую сборку, иначе после
+    # обновления они остались бы на диске навсегда (предыдущей сборки в builds/ у них нет).
+    for name in (INDEX_FILE, DOCS_FILE, "index.pkl"):
+        (VSTORE_DIR / name).unlink(missing_ok=True)
+
+
+def _store_dir() -> Path:
+    return VSTORE_DIR / CURRENT_LINK
 
 
 def _index_exists() -> bool:
-    return (VSTORE_DIR / "index.faiss").exists() and (VSTORE_DIR / "index.pkl").exists()
+    return (_store_dir() / INDEX_FILE).exists() and (_store_dir() / DOCS_FILE).exists()
 
 
 def load_store():
+    """Индекс с диска, документы — из SQLite по id.
+
+    IO_FLAG_MMAP отображает в память только инвертированные списки IVF; HNSW (по умолчанию)
+    и плоский SQ8 читаются целиком в память процесса.
+    """
     if not _index_exists():
         return None
     emb = _make_embeddings()
-    return FAISS.load_local(str(VSTORE_DIR), emb, allow_dangerous_deserialization=True)
+    # Путь через симлинк разрешаем сразу: индекс и документы должны быть из одной сборки.
+    store_dir = _store_dir().resolve()
+    index = faiss.read_index(str(store_dir / INDEX_FILE), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return FAISS(
+        embedding_function=emb,
+        index=_tune_index(index),
+        docstore=_SqliteDocstore(store_dir / DOCS_FILE),
+        index_to_docstore_id={i: i for i in range(index.ntotal)},
+        distance_strategy=(
+            DistanceStrategy.MAX_INNER_PRODUCT
+            if index.metric_type == faiss.METRIC_INNER_PRODUCT
+            else DistanceStrategy.EUCLIDEAN_DISTANCE
+        ),
+    )
 
 
 def _ensure_vs():
+    """Индекс с диска поднимается при первом запросе, один раз даже при параллельных вызовах."""
     global _vs
     if _vs is None:
-        _vs = load_store()
+        with _vs_lock:
+            if _vs is None:
+                _vs = load_store()
     return _vs
 
 
-def _cleanup_tmp():
-    shutil.rmtree(TMP_DIR, ignore_errors=True)
-
-
 class CtxReq(BaseModel):
     query: str = Field(..., min_length=1)
     k: int = 4
@@ -198,84 +679,134 @@ class RetRespItem(BaseModel):
 
 
 def _reindex_internal(rid: str):
-    global _vs, _building
+    global _vs
     try:
-        docs = load_corpus_s3()
+        c = _s3_client()
+        files = list_corpus_s3(c)
+        manifest = {"params": _build_params(), "files": files}
+        if _index_exists() and _read_manifest() == manifest:
+            log.info("[rid=%s] corpus unchanged (%d files), reindex skipped", rid, len(files))
+            return
+        docs = load_corpus_s3(c, files)
         _vs = build_store(docs)
+        _write_manifest(manifest)
+        with _ctx_cache_lock:
+            _ctx_cache.clear()
         log.info("[rid=%s] reindex done: files=%d dir=%s", rid, len(docs), VSTORE_DIR)
     except Exception as e:
         log.error("[rid=%s] reindex failed: %s", rid, e)
+
+
+async def _run_reindex(rid: str):
+    global _building
+    try:
+        await asyncio.to_thread(_reindex_internal, rid)
     finally:
-        _cleanup_tmp()
-        with _build_lock:
-            _building = False
+        _building = False
+
+
+def _start_reindex(rid: str) -> bool:
+    """Запускает реиндекс фоновой задачей; False — уже идёт."""
+    global _building, _reindex_task
+    if _building:
+        return False
+    _building = True
+    _reindex_task = asyncio.create_task(_run_reindex(rid))
+    return True
+
+
+def _warmup():
+    """Модель и индекс с диска поднимаются до приёма трафика; первый /context не платит за холодный старт."""
+    try:
+        _make_embeddings().embed_query("query: warmup")
+        _ensure_vs()
+    except Exception as e:
+        log.warning("warmup failed: %s", e)
 
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
-    rid = str(uuid.uuid4())
+    rid = _new_rid()
     log.info("[rid=%s] auto-reindex on startup...", rid)
 
-    global _building
-    with _build_lock:
-        if not _building:
-            _building = True
-            threading.Thread(target=_reindex_internal, args=(rid,), daemon=True).start()
+    _start_reindex(rid)
+    await asyncio.to_thread(_warmup)
     yield
 
-    _cleanup_tmp()
-
 
-app = FastAPI(title="rag-svc", lifespan=lifespan)
+app = FastAPI(title="rag-svc", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True, "has_index": _index_exists(), "building": _building, "model": EMB_MODEL}
 
 
 @app.post("/reindex")
-def reindex():
-    rid = str(uuid.uuid4())
-    with _build_lock:
-        if _building:
-            raise HTTPException(409, "already building")
-        _building = True
+async def reindex():
+    rid = _new_rid()
+    if not _start_reindex(rid):
+        raise HTTPException(409, "already building")
     log.info("[rid=%s] manual reindex requested", rid)
-    threading.Thread(target=_reindex_internal, args=(rid,), daemon=True).start()
     return {"ok": True, "started": True, "request_id": rid}
 
 
+def _query_key(kind: str, k: int, max_chars: int, query: str) -> bytes:
+    """Ключ кэша: запрос без регистра и лишних пробелов — повторы вопросов попадают в одну запись."""
+    norm = " ".join(query.lower().split())
+    return hashlib.blake2b(f"{kind}:{k}:{max_chars}:{norm}".encode("utf-8"), digest_size=16).digest()
+
+
+def _mmr_search(vs, q: str, k: int) -> list:
+    """MMR-поиск напрямую по стору, без сборки retriever-обёртки на каждый запрос."""
+    with torch.inference_mode():
+        return vs.max_marginal_relevance_search(
+            q, k=max(8, k), fetch_k=max(40, k * 6), lambda_mult=MMR_LAMBDA
+        )
+
+
 @app.post("/context", response_model=CtxResp)
 def context(req: CtxReq):
     vs = _ensure_vs()
     if vs is None:
         return CtxResp(context="")
 
+    key = _query_key("ctx", req.k, req.max_chars, req.query)
+    with _ctx_cache_lock:
+        cached = _ctx_cache.get(key)
+    if cached is not None:
+        return CtxResp(context=cached)
+
     q = f"query: {req.query.strip()}"
 
-    retriever = vs.as_retriever(
-        search_type="mmr",
-        search_kwargs={
-            "k": max(8, req.k),            
-            "fetch_k": max(40, req.k * 6), 
-            "lambda_mult": 0.3,            
-        },
-    )
-    docs = retriever.invoke(q)
+    docs = _mmr_search(vs, q, req.k)
 
-    pieces = []
+    # Фрагменты укладываются целиком в порядке релевантности; не влезающий
+    # пропускается, а не обрезается посередине.
+    pieces, used, first = [], 0, None
     for d in docs:
         md = getattr(d, "metadata", {}) or {}
         src = md.get("source")
         page = md.get("page")
-        src_hint = (src or "unknown").split("__")[-1]
+        src_hint = (src or "unknown").replace("__", "/").rsplit("/", 1)[-1]
         head = f"[ИСТОЧНИК: {src_hint}{'' if page is None else f', страница {page}'}]"
         body = d.page_content.replace("passage: ", "").strip()
-        if body:
-            pieces.append(f"{head}\n{body}")
-
-    text = ("\n\n---\n\n".join(pieces))[: req.max_chars]
+        if not body:
+            continue
+        piece = f"{head}\n{body}"
+        first = first or piece
+        cost = len(piece) + (len(CTX_SEPARATOR) if pieces else 0)
+        if used + cost > req.max_chars:
+            continue
+        pieces.append(piece)
+        used += cost
+
+    if not pieces and first:
+        pieces.append(first[: req.max_chars])
+
+    text = CTX_SEPARATOR.join(pieces)
+    with _ctx_cache_lock:
+        _ctx_cache[key] = text
     return CtxResp(context=text)
 
 
@@ -285,17 +816,15 @@ def retrieve(query: str, k: int = 4):
     if vs is None:
         return []
 
-    q = f"query: {query.strip()}"  
+    key = _query_key("ret", k, 0, query)
+    with _ctx_cache_lock:
+        cached = _ctx_cache.get(key)
+    if cached is not None:
+        return cached
 
-    retriever = vs.as_retriever(
-        search_type="mmr",
-        search_kwargs={
-            "k": max(8, k),
-            "fetch_k": max(40, k * 6),
-            "lambda_mult": 0.3,
-        },
-    )
-    docs = retriever.invoke(q)
+    q = f"query: {query.strip()}"
+
+    docs = _mmr_search(vs, q, k)
 
     out: list[RetRespItem] = []
     for d in docs:
@@ -307,4 +836,6 @@ def retrieve(query: str, k: int = 4):
                 text=d.page_content.replace("passage: ", ""),
             )
         )
+    with _ctx_cache_lock:
+        _ctx_cache[key] = out
     return out
@@ -15,7 +15,7 @@ find /data/vectorstore_faiss -type d -exec chmod u+rwx,g+rwx {} + 2>/dev/null ||
 
 echo "[rag] starting..."
 if command -v gosu >/dev/null 2>&1; then
-  exec gosu "$APP_USER":"$APP_USER" uvicorn app:app --host 0.0.0.0 --port 8080
+  exec gosu "$APP_USER":"$APP_USER" uvicorn app:app --host 0.0.0.0 --port 8080 --loop uvloop --http httptools
 else
-  exec su -s /bin/sh -c 'uvicorn app:app --host 0.0.0.0 --port 8080' "$APP_USER"
+  exec su -s /bin/sh -c 'uvicorn app:app --host 0.0.0.0 --port 8080 --loop uvloop --http httptools' "$APP_USER"
 fi
\ No newline at end of file
@@ -0,0 +1,30 @@
+import importlib.util
+from pathlib import Path
+
+_spec = importlib.util.spec_from_file_location("rag_app", Path(__file__).parent.parent / "app.py")
+rag = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(rag)
+
+
+def test_device_changes_cache_key_and_params(monkeypatch):
+    monkeypatch.setattr(rag, "EMB_BACKEND", "torch")
+    monkeypatch.setattr(rag, "_build_on_gpu", lambda: False)
+    cpu_tag, cpu_params = rag._emb_tag(), rag._build_params()
+    monkeypatch.setattr(rag, "_build_on_gpu", lambda: True)
+    assert rag._emb_tag() != cpu_tag
+    assert rag._build_params() != cpu_params
+
+
+def test_backend_changes_cache_key_and_params(monkeypatch):
+    monkeypatch.setattr(rag, "_onnx_qconfig", lambda: "avx2")
+    monkeypatch.setattr(rag, "EMB_BACKEND", "torch")
+    torch_tag, torch_params = rag._emb_tag(), rag._build_params()
+    monkeypatch.setattr(rag, "EMB_BACKEND", "onnx")
+    assert rag._emb_tag() != torch_tag
+    assert rag._build_params() != torch_params
+
+
+def test_onnx_backend_never_builds_on_gpu(monkeypatch):
+    monkeypatch.setattr(rag, "EMB_BACKEND", "onnx")
+    monkeypatch.setattr(rag.torch.cuda, "is_available", lambda: True)
+    assert not rag._build_on_gpu()
@@ -1,8 +1,9 @@
+import itertools
 import logging
 import os
 import re
+import time
 import unicodedata
-import uuid
 
 from fastapi import FastAPI, Request
 from pydantic import BaseModel, Field
@@ -10,6 +11,15 @@ from pydantic import BaseModel, Field
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("security-svc")
 
+# Request id: время старта + pid + счётчик — уникально между контейнерами и без urandom.
+_RID_PREFIX = f"{int(time.time()):x}{os.getpid():x}"
+_rid_seq = itertools.count(1)
+
+
+def _new_rid() -> str:
+    return f"{_RID_PREFIX}-{next(_rid_seq):x}"
+
+
 MAX_INPUT_CHARS = 16000
 NEWLINES_THRESHOLD = 50
 FENCE_THRESHOLD = 6
@@ -44,17 +54,38 @@ INJECTION_PATTERNS = [
     r"\bact\s+as\s+(?:if\s+you\s+are\s+|a\s+)?[^\n]{1,120}",
 ]
 
-COMPILED = [re.compile(p, re.IGNORECASE | re.UNICODE) for p in INJECTION_PATTERNS]
-
-RE_ZW = re.compile(r"[\u200B-\u200F\u202A-\u202E\u2060-\u206F\ufeff]")
-RE_CTRL = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F]")
+# Слова, без которых ни один паттерн выше не совпадёт.
+# Нет ни одного — regex не запускаем: так проходит большинство обычных сообщений.
+# При добавлении паттерна его обязательное слово должно попасть сюда.
+INJECTION_STEMS = (
+    "you", "system", "ignore", "disregard", "override", "pretend", "from",
+    "reset", "new", "show", "as", "act",
+    "следуй", "забудь", "должен", "говори", "раскрой", "выведи",
+)
+# Проверяются тем же IGNORECASE, что и INJECTION_RE: простое `in` не видит
+# юникодных эквивалентов регистра (ı ≈ i, ᲀ ≈ в), которые regex считает совпадением.
+_STEMS_RE = re.compile("|".join(map(re.escape, INJECTION_STEMS)), re.IGNORECASE)
+
+# Одна альтернация вместо цикла по списку: текст проходится один раз,
+# а сработавшее правило видно по имени группы (p<индекс>).
+INJECTION_RE = re.compile(
+    "|".join(f"(?P<p{i}>{p})" for i, p in enumerate(INJECTION_PATTERNS)),
+    re.IGNORECASE | re.UNICODE,
+)
+
+# Zero-width, bidi-управляющие и контрольные символы: вырезаются одним str.translate.
+_STRIP_TABLE = dict.fromkeys([
+    *range(0x200B, 0x2010), *range(0x202A, 0x202F), *range(0x2060, 0x2070), 0xFEFF,
+    *range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20),
+])
 RE_BASE64_RUN = re.compile(r"[A-Za-z0-9+/=]{%d,}" % BASE64_MIN_RUN)
 
 def _normalize(t: str) -> str:
     """Unicode NFKC, вырезание zero-width/контрольных, схлопывание пробелов, lower()."""
-    t = unicodedata.normalize("NFKC", t or "")
-    t = RE_ZW.sub("", t)
-    t = RE_CTRL.sub("", t)
+    t = t or ""
+    if not t.isascii():
+        t = unicodedata.normalize("NFKC", t)
+    t = t.translate(_STRIP_TABLE)
     t = " ".join(t.split()) if t.count("\n") == 0 else t
     return t.lower()
 
@@ -70,11 +101,20 @@ def _suspicious(t: str) -> bool:
         return True
     return False
 
-def detect_injection(text: str) -> bool:
+def get_detected_pattern(text: str) -> str | None:
+    """Какое правило сработало: "heuristic", текст regex-паттерна или None."""
     t = _normalize(text)
     if _suspicious(t):
-        return True
-    return any(p.search(t) for p in COMPILED)
+        return "heuristic"
+    if not _STEMS_RE.search(t):
+        return None
+    m = INJECTION_RE.search(t)
+    if m is None:
+        return None
+    return INJECTION_PATTERNS[int(m.lastgroup[1:])]
+
+def detect_injection(text: str) -> bool:
+    return get_detected_pattern(text) is not None
 
 
 class DetectReq(BaseModel):
@@ -88,14 +128,18 @@ class DetectResp(BaseModel):
 app = FastAPI(title="security-svc")
 
 @app.post("/detect", response_model=DetectResp)
-def detect(req: DetectReq, request: Request):
-    rid = request.headers.get("X-Request-ID") or str(uuid.uuid4())
-    result = detect_injection(req.text)
-    log.info("[rid=%s] detect -> %s", rid, result)
+async def detect(req: DetectReq, request: Request):
+    rid = request.headers.get("X-Request-ID") or _new_rid()
+    pattern = get_detected_pattern(req.text)
+    result = pattern is not None
+    if result:
+        log.info("[rid=%s] detect -> True (%s)", rid, pattern)
+    else:
+        log.info("[rid=%s] detect -> False", rid)
     return DetectResp(is_injection=result)
 
 @app.get("/health")
-def health():
+async def health():
     return {
         "ok": True,
         "limits": {
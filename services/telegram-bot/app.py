@@ -1,10 +1,12 @@
 import os
+import json
 import logging
 import asyncio
 
 import httpx
 from telegram import Update
 from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
 logging.basicConfig(level=logging.INFO)
@@ -16,6 +18,22 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 MAX_QUESTION_CHARS = 8000
 REQUEST_TIMEOUT_S = 60
 RETRIES = 1
+STREAM_EDIT_INTERVAL_S = 1.0
+TG_MAX_MESSAGE = 4096
+
+# Один клиент на процесс: keep-alive до gateway живёт между сообщениями.
+_http: httpx.AsyncClient | None = None
+
+async def _on_start(_app: Application):
+    global _http
+    _http = httpx.AsyncClient(
+        timeout=httpx.Timeout(REQUEST_TIMEOUT_S),
+        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+    )
+
+async def _on_stop(_app: Application):
+    if _http is not None:
+        await _http.aclose()
 
 def _chunks(s: str, n: int = 4096):
     for i in range(0, len(s), n):
@@ -31,30 +49,86 @@ async def forget(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Очистка истории диалога для данного пользователя в gateway."""
     uid = str(update.effective_user.id)
     try:
-        timeout = httpx.Timeout(REQUEST_TIMEOUT_S)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            r = await client.delete(f"{GATEWAY_URL}/history", params={"user_id": uid})
-            r.raise_for_status()
+        r = await _http.delete(f"{GATEWAY_URL}/history", params={"user_id": uid})
+        r.raise_for_status()
         await update.message.reply_text("история очищена.")
     except Exception as e:
         log.exception("forget error: %s", e)
         await update.message.reply_text("не получилось очистить историю :(")
 
 async def _ask_gateway(question: str, user_id: str, chat_id: str | None) -> str:
-    timeout = httpx.Timeout(REQUEST_TIMEOUT_S)
-    limits = httpx.Limits(max_keepalive_connections=10, max_connections=20)
-    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
-        last_err = None
-        payload = {"question": question, "user_id": user_id, "chat_id": chat_id}
-        for attempt in range(RETRIES + 1):
-            try:
-                r = await client.post(f"{GATEWAY_URL}/ask", json=payload)
-                r.raise_for_status()
-                return r.json().get("answer", "упс, пустой ответ")
-            except Exception as e:
-                last_err = e
-                await asyncio.sleep(0.3 * (attempt + 1))
-        raise last_err
+    last_err = None
+    payload = {"question": question, "user_id": user_id, "chat_id": chat_id}
+    for attempt in range(RETRIES + 1):
+        try:
+            r = await _http.post(f"{GATEWAY_URL}/ask", json=payload)
+            r.raise_for_status()
+            return r.json().get("answer", "упс, пустой ответ")
+        except Exception as e:
+            last_err = e
+            await asyncio.sleep(0.3 * (attempt + 1))
+    raise last_err
+
+async def _tg_show(update: Update, msg, text: str, shown: str):
+    """Первое сообщение или правка с text; возвращает (msg, shown).
+    Ошибки Telegram (RetryAfter, BadRequest) только логируются — чтение потока из gateway не прерывают."""
+    if text.rstrip() == shown.rstrip():
+        return msg, shown
+    try:
+        if msg is None:
+            msg = await update.message.reply_text(text)
+        else:
+            await msg.edit_text(text)
+        return msg, text
+    except TelegramError as e:
+        log.warning("telegram update failed: %s", e)
+        return msg, shown
+
+async def _stream_answer(update: Update, question: str, user_id: str, chat_id: str | None) -> bool:
+    """Ответ через /ask/stream: первое сообщение появляется с первыми токенами и
+    дописывается правками не чаще раза в STREAM_EDIT_INTERVAL_S.
+    False — поток не открылся (можно повторить обычным /ask). Если gateway уже принял
+    запрос, вопрос записан в историю им самим, и повтор через /ask задвоил бы его."""
+    payload = {"question": question, "user_id": user_id, "chat_id": chat_id}
+    loop = asyncio.get_running_loop()
+    msg, shown, text, last_edit = None, "", "", 0.0
+    opened = failed = False
+    try:
+        async with _http.stream("POST", f"{GATEWAY_URL}/ask/stream", json=payload) as r:
+            r.raise_for_status()
+            opened = True
+            async for line in r.aiter_lines():
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if "error" in data:
+                    log.warning("gateway stream error: %s", data["error"])
+                    failed = True
+                    break
+                text += data.get("delta", "")
+                now = loop.time()
+                if text and now - last_edit >= STREAM_EDIT_INTERVAL_S and len(text) <= TG_MAX_MESSAGE:
+                    msg, shown = await _tg_show(update, msg, text, shown)
+                    last_edit = now
+    except (httpx.HTTPError, ValueError) as e:
+        if not opened:
+            log.warning("stream failed to open: %s", e)
+            return False
+        log.exception("stream interrupted: %s", e)
+        failed = True
+
+    if failed:
+        text = f"{text}\n\n(ответ прервался, попробуй позже)" if text else "не получилось, попробуй позже"
+    if not text:
+        text = "упс, пустой ответ"
+    parts = list(_chunks(text, TG_MAX_MESSAGE))
+    msg, shown = await _tg_show(update, msg, parts[0], shown)
+    for part in parts[1:]:
+        try:
+            await update.message.reply_text(part)
+        except TelegramError as e:
+            log.warning("telegram reply failed: %s", e)
+    return True
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = (update.message.text or "").strip()
@@ -71,6 +145,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+        if await _stream_answer(update, q, uid, cid):
+            return
         ans = await _ask_gateway(q, uid, cid)
         for part in _chunks(ans, 4096):
             await update.message.reply_text(part)
@@ -82,7 +158,7 @@ def main():
     if not TELEGRAM_TOKEN:
         raise RuntimeError("TELEGRAM_TOKEN is not set")
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    app = Application.builder().token(TELEGRAM_TOKEN).post_init(_on_start).post_shutdown(_on_stop).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("forget", forget))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))